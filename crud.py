@@ -1,19 +1,319 @@
 import os
+import re
+import time
+import random
+import asyncio
 import logging
+import contextlib
 import httpx
-from typing import Optional, Dict, Any, List
+import orjson
+from cachetools import LRUCache, TTLCache
+from collections import deque
+from typing import Optional, Dict, Any, List, Deque, Tuple, Union
+from urllib.parse import urlsplit
 from motor.motor_asyncio import AsyncIOMotorCollection
-from datetime import datetime
-from pymongo import UpdateOne
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import PyMongoError
+
+BULK_CHUNK_SIZE = 1000
+FETCH_WORKERS = 64
 
 OFF_API_BASE = "https://world.openfoodfacts.org/api/v0/product"
+# Only request the fields fetch_from_off reads; full OFF payloads are 50-200 KB
+OFF_FIELDS = ",".join((
+    "product_name",
+    "product_name_en",
+    "generic_name",
+    "generic_name_en",
+    "brands",
+    "categories",
+    "ingredients",
+    "nutriments",
+    "allergens_hierarchy",
+    "ecoscore_score",
+    "packaging",
+    "serving_size",
+    "status",
+))
 CARBON_API_URL = "https://api.carboninterface.com/v1/estimates"
 CARBON_API_KEY = os.getenv("CARBON_API_KEY")
 
 logger = logging.getLogger("barcode-api")
 
+# OFF nutriments carrying g CO2e per 100 g of the whole product, in order of
+# preference (the meat-or-fish figure covers only part of it, so it is skipped)
+OFF_CARBON_KEYS = (
+    "carbon-footprint_100g",
+    "carbon-footprint-from-known-ingredients_100g",
+)
+
+# Matches "recyclable", "recycle", "please recycle", ...
+_PACK_RE = re.compile(r"recyclab|recycle", re.IGNORECASE)
+
+# Outbound throttling / retry policy
+RETRY_STATUSES = {429, 502, 503, 504}
+MAX_ATTEMPTS = 3
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_WAIT = 8.0
+HOST_CONCURRENCY = 16
+DEFAULT_HOST_RPS = 10
+HOST_RPS = {
+    "world.openfoodfacts.org": 10,
+    "api.carboninterface.com": 5,
+}
+
+
+class UpstreamError(Exception):
+    """
+    Raised when an upstream API still answers 429/5xx after every retry.
+    """
+
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class UpstreamThrottledError(UpstreamError):
+    """
+    Upstream kept answering 429 Too Many Requests.
+    """
+
+
+class UpstreamUnavailableError(UpstreamError):
+    """
+    Upstream kept answering 502/503/504.
+    """
+
+
+class SlidingWindowLimiter:
+    """
+    Allows at most `rate` acquisitions in any rolling `period` seconds.
+    """
+
+    def __init__(self, rate: int, period: float = 1.0):
+        self.rate = rate
+        self.period = period
+        self._stamps: Deque[float] = deque()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                while self._stamps and now - self._stamps[0] >= self.period:
+                    self._stamps.popleft()
+                if len(self._stamps) < self.rate:
+                    self._stamps.append(now)
+                    return
+                await asyncio.sleep(self.period - (now - self._stamps[0]))
+
+
+class AIMDLimiter:
+    """
+    Adaptive concurrency limit (additive increase, multiplicative decrease).
+
+    `async with limiter:` holds one of `int(limit)` slots. Upstream health is
+    reported separately via `observe(latency, status_code)` for every response,
+    so only the request itself is timed. The limit grows by `increase` while the
+    rolling average latency stays within `target_latency`, and is cut by
+    `decrease` on a 429/5xx, a slow window, or an exception inside the block.
+    Cuts are at least `cooldown` seconds apart, so one burst halves it once.
+    """
+
+    def __init__(
+        self,
+        initial: float = 5,
+        min_limit: float = 1,
+        max_limit: float = 64,
+        increase: float = 0.5,
+        decrease: float = 0.5,
+        target_latency: float = 1.0,
+        window: int = 32,
+        cooldown: float = 1.0,
+    ):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.target_latency = target_latency
+        self.cooldown = cooldown
+        self._samples: Deque[float] = deque(maxlen=window)
+        self._last_decrease = float("-inf")
+        self._in_flight = 0
+        self._cond = asyncio.Condition()
+
+    async def __aenter__(self) -> "AIMDLimiter":
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._in_flight < int(self.limit))
+            self._in_flight += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        if exc_type is not None:
+            self._back_off()  # timeouts / connection errors
+        async with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def observe(self, latency: float, status_code: int) -> None:
+        if status_code in RETRY_STATUSES:
+            self._back_off()
+            return
+        self._samples.append(latency)
+        if sum(self._samples) / len(self._samples) > self.target_latency:
+            self._back_off()
+        else:
+            self.limit = min(self.max_limit, self.limit + self.increase)
+
+    def _back_off(self) -> None:
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        self.limit = max(self.min_limit, self.limit * self.decrease)
+        self._samples.clear()  # judge the new limit on fresh samples
+
+
+_host_gates: Dict[str, Tuple[asyncio.Semaphore, SlidingWindowLimiter]] = {}
+
+
+def _gate_for(url: str) -> Tuple[asyncio.Semaphore, SlidingWindowLimiter]:
+    host = urlsplit(url).hostname or ""
+    gate = _host_gates.get(host)
+    if gate is None:
+        gate = (
+            asyncio.Semaphore(HOST_CONCURRENCY),
+            SlidingWindowLimiter(HOST_RPS.get(host, DEFAULT_HOST_RPS)),
+        )
+        _host_gates[host] = gate
+    return gate
 
-async def fetch_carbon_footprint(grams: float) -> Optional[float]:
+
+def _retry_after(resp: httpx.Response) -> Optional[float]:
+    # Retry-After is either delta-seconds or an HTTP-date
+    value = resp.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+def _backoff_delay(attempt: int) -> float:
+    return min(RETRY_MAX_WAIT, RETRY_BASE_DELAY * 2 ** attempt) + random.uniform(0, RETRY_BASE_DELAY)
+
+
+def _upstream_error(method: str, url: str, resp: httpx.Response, reason: str) -> UpstreamError:
+    cls = UpstreamThrottledError if resp.status_code == 429 else UpstreamUnavailableError
+    return cls(f"{method} {url} -> {resp.status_code} ({reason})", resp.status_code)
+
+
+async def _request_with_retry(
+    client: httpx.AsyncClient,
+    method: str,
+    url: str,
+    limiter: Optional[AIMDLimiter] = None,
+    **kw
+) -> httpx.Response:
+    """
+    Rate-limited request per host, retried with exponential backoff on 429/5xx.
+    A Retry-After header is honored as-is; if it asks for more than
+    RETRY_MAX_WAIT we give up right away instead of holding the request open.
+    Raises UpstreamThrottledError (429) or UpstreamUnavailableError (5xx)
+    when retries are exhausted. If `limiter` is given, each attempt holds one
+    of its slots and reports the response (including retried 429/5xx) to it.
+    """
+    semaphore, rate_limiter = _gate_for(url)
+    for attempt in range(MAX_ATTEMPTS):
+        async with limiter or contextlib.nullcontext():
+            async with semaphore:
+                await rate_limiter.acquire()
+                started = time.monotonic()
+                resp = await client.request(method, url, **kw)
+            if limiter is not None:
+                limiter.observe(time.monotonic() - started, resp.status_code)
+        if resp.status_code not in RETRY_STATUSES:
+            return resp
+        if attempt == MAX_ATTEMPTS - 1:
+            raise _upstream_error(method, url, resp, f"after {MAX_ATTEMPTS} attempts")
+        retry_after = _retry_after(resp)
+        if retry_after is not None and retry_after > RETRY_MAX_WAIT:
+            raise _upstream_error(method, url, resp, f"Retry-After {retry_after:.0f}s")
+        delay = retry_after if retry_after is not None else _backoff_delay(attempt)
+        logger.warning(f"{method} {url} -> {resp.status_code}, retrying in {delay:.2f}s")
+        await asyncio.sleep(delay)
+
+
+# Carbon estimates depend only on the (rounded) weight, so cache them by grams,
+# with single-flight so concurrent misses for one weight share a lookup
+_carbon_cache: LRUCache = LRUCache(maxsize=2048)
+_carbon_inflight: Dict[int, "asyncio.Future[Optional[float]]"] = {}
+
+
+async def fetch_carbon_footprint(
+    grams: float,
+    client: httpx.AsyncClient,
+    cache_collection: Optional[AsyncIOMotorCollection] = None
+) -> Optional[float]:
+    """
+    Carbon footprint (kg CO2e) for a weight in grams, cached by rounded grams
+    in-process and, if `cache_collection` is given, in Mongo across processes.
+    """
+    key = round(grams)
+    if key in _carbon_cache:
+        return _carbon_cache[key]
+
+    fut = _carbon_inflight.get(key)
+    if fut is None:
+        fut = asyncio.ensure_future(_load_carbon_footprint(key, client, cache_collection))
+        _carbon_inflight[key] = fut
+        fut.add_done_callback(lambda _: _carbon_inflight.pop(key, None))
+    return await asyncio.shield(fut)
+
+
+async def _load_carbon_footprint(
+    key: int,
+    client: httpx.AsyncClient,
+    cache_collection: Optional[AsyncIOMotorCollection]
+) -> Optional[float]:
+    # Mongo carbon_cache first, then the Carbon API; fills both caches.
+    # The Mongo cache is best-effort: if it is down, fall back to the API
+    # and still return the estimate.
+    if cache_collection is not None:
+        try:
+            hit = await cache_collection.find_one({"_id": key})
+        except PyMongoError as e:
+            logger.warning("Carbon cache read failed for %sg: %s", key, e)
+            hit = None
+        if hit:
+            _carbon_cache[key] = hit["carbon_kg"]
+            return hit["carbon_kg"]
+
+    carbon_kg = await request_carbon_estimate(key, client)
+    if carbon_kg is not None:
+        _carbon_cache[key] = carbon_kg
+        if cache_collection is not None:
+            try:
+                await cache_collection.update_one(
+                    {"_id": key},
+                    {"$set": {"carbon_kg": carbon_kg, "cached_at": datetime.utcnow()}},
+                    upsert=True
+                )
+            except PyMongoError as e:
+                logger.warning("Carbon cache write failed for %sg: %s", key, e)
+    return carbon_kg
+
+
+async def request_carbon_estimate(grams: float, client: httpx.AsyncClient) -> Optional[float]:
     """
     Given weight in grams, call Carbon Interface to get kg CO2e.
     Logs any non-201 response or request errors.
@@ -30,38 +330,58 @@ async def fetch_carbon_footprint(grams: float) -> Optional[float]:
         "Content-Type": "application/json"
     }
     try:
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(
-                CARBON_API_URL,
-                json=payload,
-                headers=headers,
-                timeout=10.0
-            )
+        resp = await _request_with_retry(
+            client,
+            "POST",
+            CARBON_API_URL,
+            json=payload,
+            headers=headers,
+            timeout=10.0
+        )
         if resp.status_code != 201:
             logger.warning(f"Carbon API non-201: {resp.status_code} body={resp.text}")
             return None
-        data = resp.json().get("data", {}).get("attributes", {})
+        body = orjson.loads(resp.content)
+        data = body.get("data", {}).get("attributes", {})
         return data.get("carbon_kg")
     except httpx.RequestError as e:
         logger.error(f"Carbon API request error: {e}")
         return None
+    except UpstreamError as e:
+        # Carbon is optional enrichment; don't fail the product over it
+        logger.warning(f"Carbon API unavailable: {e}")
+        return None
     except ValueError as e:
         logger.error(f"Carbon API JSON parse error: {e}")
         return None
 
 
-async def fetch_from_off(barcode: str) -> Optional[Dict[str, Any]]:
+async def fetch_from_off(
+    barcode: str,
+    client: httpx.AsyncClient,
+    carbon_cache: Optional[AsyncIOMotorCollection] = None,
+    limiter: Optional[AIMDLimiter] = None
+) -> Optional[Dict[str, Any]]:
     """
     Fetch product data from OpenFoodFacts by barcode and enrich with sustainability data.
+    Returns None if the product doesn't exist; raises UpstreamError
+    if OpenFoodFacts keeps throttling or failing. `limiter` gates only the
+    OpenFoodFacts request, not the carbon enrichment.
     """
     url = f"{OFF_API_BASE}/{barcode}.json"
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(url, timeout=10.0)
+    resp = await _request_with_retry(
+        client, "GET", url, limiter=limiter, params={"fields": OFF_FIELDS}, timeout=10.0
+    )
+
+    if resp.status_code != 200:
+        return None
 
-    if resp.status_code != 200 or resp.json().get("status") != 1:
+    # Parse the (potentially large) OFF payload once
+    body = orjson.loads(resp.content)
+    if body.get("status") != 1:
         return None
 
-    p = resp.json()["product"]
+    p = body["product"]
 
     # Product name fallback logic
     name = (
@@ -83,10 +403,7 @@ async def fetch_from_off(barcode: str) -> Optional[Dict[str, Any]]:
 
     # Packaging recyclability check
     pack_str = p.get("packaging", "") or ""
-    pack_recyclable = any(
-        kw in pack_str.lower()
-        for kw in ("recyclable", "recycle", "please recycle")
-    )
+    pack_recyclable = bool(_PACK_RE.search(pack_str))
 
     # Grams estimate (from serving_size or default to 100g)
     grams: float
@@ -101,8 +418,16 @@ async def fetch_from_off(barcode: str) -> Optional[Dict[str, Any]]:
     else:
         grams = 100.0
 
-    # Try to get carbon footprint
-    carbon_kg = await fetch_carbon_footprint(grams)
+    # Carbon footprint: prefer OFF's own figure, else ask Carbon Interface
+    off_carbon = next(
+        (v for k in OFF_CARBON_KEYS
+         if isinstance(v := p.get("nutriments", {}).get(k), (int, float))),
+        None
+    )
+    if off_carbon is not None:
+        carbon_kg = off_carbon * grams / 100_000  # g per 100 g -> kg
+    else:
+        carbon_kg = await fetch_carbon_footprint(grams, client, carbon_cache)
 
     return {
         "barcode": barcode,
@@ -128,51 +453,154 @@ async def fetch_from_off(barcode: str) -> Optional[Dict[str, Any]]:
     }
 
 
+# Short-lived in-process cache of OFF lookups, with single-flight for concurrent misses
+_off_cache: TTLCache = TTLCache(maxsize=10_000, ttl=300)
+_off_inflight: Dict[str, "asyncio.Future[Optional[Dict[str, Any]]]"] = {}
+
+
+async def cached_fetch_from_off(
+    barcode: str,
+    client: httpx.AsyncClient,
+    carbon_cache: Optional[AsyncIOMotorCollection] = None,
+    limiter: Optional[AIMDLimiter] = None
+) -> Optional[Dict[str, Any]]:
+    """
+    fetch_from_off behind a TTL cache; concurrent callers for the same
+    barcode share a single in-flight request. Misses (None) are not cached.
+    """
+    if barcode in _off_cache:
+        return _off_cache[barcode]
+
+    fut = _off_inflight.get(barcode)
+    if fut is None:
+        fut = asyncio.ensure_future(fetch_from_off(barcode, client, carbon_cache, limiter))
+        _off_inflight[barcode] = fut
+        fut.add_done_callback(lambda _: _off_inflight.pop(barcode, None))
+
+    data = await asyncio.shield(fut)
+    if data is not None:
+        _off_cache[barcode] = data
+    return data
+
+
+async def fetch_many_from_off(
+    barcodes: List[str],
+    client: httpx.AsyncClient,
+    limiter: Optional[AIMDLimiter] = None,
+    carbon_cache: Optional[AsyncIOMotorCollection] = None
+) -> Dict[str, Union[Dict[str, Any], None, Exception]]:
+    """
+    Fetch many barcodes over the shared pooled client using a bounded pool
+    of workers, so memory scales with FETCH_WORKERS rather than len(barcodes).
+    Returns a mapping of barcode -> product data, None when not found, or the
+    httpx.RequestError / UpstreamError that failed that barcode.
+    """
+    results: Dict[str, Union[Dict[str, Any], None, Exception]] = {}
+    queue: "asyncio.Queue[str]" = asyncio.Queue()
+    for code in barcodes:
+        queue.put_nowait(code)
+
+    async def worker():
+        while not queue.empty():
+            code = queue.get_nowait()
+            # One failing barcode must not cancel the other workers
+            try:
+                results[code] = await cached_fetch_from_off(code, client, carbon_cache, limiter)
+            except (httpx.RequestError, UpstreamError) as e:
+                logger.warning(f"OFF fetch failed for {code}: {e!r}")
+                results[code] = e
+
+    async with asyncio.TaskGroup() as tg:
+        for _ in range(min(FETCH_WORKERS, len(barcodes))):
+            tg.create_task(worker())
+    return results
+
+
+# Only the fields ProductOut needs, with _id returned as a string.
+# Aggregation expressions in find/findAndModify projections need MongoDB 4.4+.
+PRODUCT_PROJECTION = {
+    "_id": {"$toString": "$_id"},
+    "barcode": 1,
+    "name": 1,
+    "brand": 1,
+    "category": 1,
+    "ingredients": 1,
+    "nutriments": 1,
+    "allergens": 1,
+    "eco": 1,
+}
+
+
 async def upsert_product(collection: AsyncIOMotorCollection, data: Dict[str, Any]) -> Dict[str, Any]:
     """
-    Upserts a single product document into the MongoDB collection.
+    Upserts a single product document into the MongoDB collection
+    and returns the stored document in the same round-trip.
     """
-    await collection.update_one(
+    return await collection.find_one_and_update(
         {"barcode": data["barcode"]},
         {"$set": data},
+        projection=PRODUCT_PROJECTION,
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+
+
+def _bulk_upsert_op(doc: Dict[str, Any]) -> UpdateOne:
+    # fetched_at only on insert, so re-upserting doesn't push back the TTL
+    fields = {k: v for k, v in doc.items() if k != "fetched_at"}
+    return UpdateOne(
+        {"barcode": doc["barcode"]},
+        {
+            "$set": fields,
+            "$setOnInsert": {"fetched_at": doc.get("fetched_at") or datetime.utcnow()},
+        },
         upsert=True
     )
-    doc = await collection.find_one({"barcode": data["barcode"]})
-    if doc and "_id" in doc:
-        doc["_id"] = str(doc["_id"])  # Serialize ObjectId
-    return doc
 
 
-async def bulk_upsert_products(collection: AsyncIOMotorCollection, docs: List[Dict[str, Any]]):
+async def bulk_upsert_products(collection: AsyncIOMotorCollection, docs: List[Dict[str, Any]]) -> Dict[str, str]:
     """
     Performs a bulk upsert of multiple products.
+    Upserts are independent, so they run unordered and in chunks.
+    Returns barcode -> new `_id` (as string) for documents that were inserted.
     """
-    operations = [
-        UpdateOne({"barcode": doc["barcode"]}, {"$set": doc}, upsert=True)
-        for doc in docs
-    ]
-    if operations:
-        await collection.bulk_write(operations)
+    upserted: Dict[str, str] = {}
+    for i in range(0, len(docs), BULK_CHUNK_SIZE):
+        chunk = docs[i:i + BULK_CHUNK_SIZE]
+        # No collection validators are defined, so skip validation too
+        result = await collection.bulk_write(
+            [_bulk_upsert_op(doc) for doc in chunk],
+            ordered=False,
+            bypass_document_validation=True
+        )
+        for idx, _id in result.upserted_ids.items():
+            upserted[chunk[idx]["barcode"]] = str(_id)
+    return upserted
 
 
 async def get_product(collection: AsyncIOMotorCollection, barcode: str) -> Optional[Dict[str, Any]]:
     """
     Retrieve a product by barcode.
     """
-    doc = await collection.find_one({"barcode": barcode})
-    if doc and "_id" in doc:
-        doc["_id"] = str(doc["_id"])  # Serialize ObjectId
-    return doc
+    return await collection.find_one({"barcode": barcode}, projection=PRODUCT_PROJECTION)
 
 
-async def search_products(collection: AsyncIOMotorCollection, query: Dict[str, Any]) -> List[Dict[str, Any]]:
+async def get_products(collection: AsyncIOMotorCollection, barcodes: List[str]) -> Dict[str, Dict[str, Any]]:
     """
-    Search products using a MongoDB query.
+    Retrieve many products in a single round-trip, keyed by barcode.
     """
-    cursor = collection.find(query)
-    results = await cursor.to_list(length=100)
-    for doc in results:
-        if "_id" in doc:
-            doc["_id"] = str(doc["_id"])  # Serialize ObjectId
-    return results
+    docs: Dict[str, Dict[str, Any]] = {}
+    async for doc in collection.find({"barcode": {"$in": barcodes}}, projection=PRODUCT_PROJECTION):
+        docs[doc["barcode"]] = doc
+    return docs
+
+
+async def search_products(collection: AsyncIOMotorCollection, text: str) -> List[Dict[str, Any]]:
+    """
+    Case-insensitive substring search over product name and brand.
+    """
+    pattern = {"$regex": re.escape(text), "$options": "i"}
+    query = {"$or": [{"name": pattern}, {"brand": pattern}]}
+    cursor = collection.find(query, projection=PRODUCT_PROJECTION).batch_size(100).limit(100)
+    return [doc async for doc in cursor]
 
@@ -1,21 +1,68 @@
 # database.py
 
 import os
+import logging
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import OperationFailure
 
 
 MONGO_URI = os.getenv("MONGODB_URI")
 DB_NAME = os.getenv("DB_NAME", "products_db")
 COLLECTION_NAME = os.getenv("COLLECTION_NAME", "products")
+CARBON_CACHE_COLLECTION_NAME = os.getenv("CARBON_CACHE_COLLECTION_NAME", "carbon_cache")
 
 client = AsyncIOMotorClient(MONGO_URI)
 db = client[DB_NAME]
 collection = db[COLLECTION_NAME]
+carbon_cache = db[CARBON_CACHE_COLLECTION_NAME]
+
+logger = logging.getLogger("barcode-api")
+
+async def dedupe_barcodes(apply: bool = False) -> int:
+    # Keep only the most recently fetched document per barcode. Products are
+    # a re-fetchable cache of OFF data, so dropping older copies is safe.
+    # Only run from dedupe_barcodes.py; reports without deleting unless apply.
+    pipeline = [
+        {"$sort": {"fetched_at": -1}},
+        {"$group": {"_id": "$barcode", "ids": {"$push": "$_id"}, "n": {"$sum": 1}}},
+        {"$match": {"n": {"$gt": 1}}},
+    ]
+    total = 0
+    async for group in collection.aggregate(pipeline, allowDiskUse=True):
+        stale = group["ids"][1:]
+        total += len(stale)
+        logger.warning(
+            "barcode %s: %s %d older duplicate(s)",
+            group["_id"], "deleting" if apply else "would delete", len(stale)
+        )
+        if apply:
+            await collection.delete_many({"_id": {"$in": stale}})
+    logger.warning("%s %d duplicate product document(s)", "Deleted" if apply else "Found", total)
+    return total
 
 async def ensure_indexes():
+    # Unique index on barcode: every hot-path lookup filters on it.
+    # Collections created before this index may hold duplicate barcodes
+    # (racing upserts). Never delete data at startup: report it and keep
+    # serving; dedupe_barcodes.py cleans up so the next start can build it.
+    try:
+        await collection.create_index("barcode", unique=True)
+    except OperationFailure as e:
+        if e.code != 11000:  # duplicate key
+            raise
+        logger.error(
+            "Unique barcode index not built: %s has duplicate barcodes. "
+            "Run `python dedupe_barcodes.py` to review and `--apply` to remove them.",
+            COLLECTION_NAME
+        )
     # TTL index on fetched_at: documents expire 24h after fetched_at
     await collection.create_index(
         "fetched_at",
         expireAfterSeconds=86400
     )
+    # TTL index on carbon_cache: estimates expire 30 days after cached_at
+    await carbon_cache.create_index(
+        "cached_at",
+        expireAfterSeconds=30 * 86400
+    )
 print("🚀 MONGO_URI:", os.environ.get("MONGODB_URI"))
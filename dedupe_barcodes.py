@@ -0,0 +1,29 @@
+# dedupe_barcodes.py
+"""
+One-off cleanup for collections created before the unique barcode index.
+
+Keeps the most recently fetched document per barcode and removes the rest.
+Dry run by default:
+
+    python dedupe_barcodes.py           # list duplicates
+    python dedupe_barcodes.py --apply   # delete them
+"""
+
+import argparse
+import asyncio
+import logging
+
+from database import dedupe_barcodes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--apply", action="store_true", help="delete the duplicates instead of only listing them")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    asyncio.run(dedupe_barcodes(apply=args.apply))
+
+
+if __name__ == "__main__":
+    main()
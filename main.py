@@ -1,13 +1,13 @@
 import logging
 import uuid
-import asyncio
+import httpx
 
 from fastapi import FastAPI, Request, HTTPException, status, Query
 from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel
 from typing import List, Dict, Any, Union
 
-from database import collection, ensure_indexes
+from database import collection, carbon_cache, ensure_indexes
 import crud
 from schemas import (
     ProductOut,
@@ -31,11 +31,24 @@ app = FastAPI(
     description="Now with per-item errors, throttling, TTL, bulk upserts, and batch metadata!"
 )
 
-# ─── ensure TTL index on startup ───────────
+# Adaptive OFF concurrency, shared across batch requests
+off_limiter = crud.AIMDLimiter(initial=5, min_limit=1, max_limit=64, target_latency=1.0, window=32)
+
+# ─── ensure indexes + shared HTTP client on startup ───
 @app.on_event("startup")
 async def on_startup():
     await ensure_indexes()
-    logger.info("TTL index on 'fetched_at' ensured")
+    logger.info("Indexes on 'barcode' and 'fetched_at' (TTL) ensured")
+    # One pooled client for OFF + Carbon Interface, reused across requests
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        timeout=10.0,
+        limits=httpx.Limits(max_keepalive_connections=64, max_connections=64),
+    )
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await app.state.http.aclose()
 
 # ─── request logging middleware ────────────
 @app.middleware("http")
@@ -70,20 +83,31 @@ class BarcodesInput(BaseModel):
     status_code=status.HTTP_201_CREATED,
     summary="Fetch live from OFF and upsert single product"
 )
-async def create_or_update_product(barcode_in: BarcodeInput):
+async def create_or_update_product(barcode_in: BarcodeInput, request: Request):
     try:
-        off_data = await crud.fetch_from_off(barcode_in.barcode)
+        off_data = await crud.fetch_from_off(barcode_in.barcode, request.app.state.http, carbon_cache)
         if not off_data:
             raise HTTPException(
                 status_code=404,
                 detail="Product not found in OpenFoodFacts"
             )
-        await crud.bulk_upsert_products(collection, [off_data])
-        doc = await crud.get_product(collection, barcode_in.barcode)
-        return doc
+        doc = await crud.upsert_product(collection, off_data)
+        return ProductOut.from_doc(doc)
 
     except HTTPException:
         raise
+    except crud.UpstreamThrottledError:
+        logger.warning("OpenFoodFacts throttled create_or_update_product")
+        raise HTTPException(
+            status_code=503,
+            detail="OpenFoodFacts is rate limiting requests, try again later"
+        )
+    except crud.UpstreamUnavailableError as e:
+        logger.warning(f"OpenFoodFacts unavailable in create_or_update_product: {e}")
+        raise HTTPException(
+            status_code=502,
+            detail="OpenFoodFacts is unavailable, try again later"
+        )
     except Exception:
         logger.exception("Error in create_or_update_product")
         raise HTTPException(
@@ -98,51 +122,74 @@ async def create_or_update_product(barcode_in: BarcodeInput):
     status_code=status.HTTP_200_OK,
     summary="Batch lookup with metadata, throttling, and error reporting"
 )
-async def batch_lookup(batch: BarcodesInput):
+async def batch_lookup(batch: BarcodesInput, request: Request):
+    http_client = request.app.state.http
     requested = len(batch.barcodes)
+    codes = list(dict.fromkeys(batch.barcodes))  # fetch each code once
     fetched = 0
     cached = 0
 
-    semaphore = asyncio.Semaphore(5)
     new_products: List[Dict[str, Any]] = []
     results: List[Union[Dict[str, Any], Dict[str, str]]] = []
+    placeholder_idx: Dict[str, List[int]] = {}
 
-    async def process_one(code: str):
-        nonlocal fetched, cached
-        # 1. Try cache
-        doc = await crud.get_product(collection, code)
+    # 1. Probe the cache for every barcode in one round-trip
+    cached_docs = await crud.get_products(collection, codes)
+
+    # 2. Throttled bulk fetch of every cache miss
+    misses = [c for c in codes if c not in cached_docs]
+    off_results = await crud.fetch_many_from_off(misses, http_client, off_limiter, carbon_cache)
+
+    # 3. Assemble one result per requested barcode, in request order
+    for code in batch.barcodes:
+        doc = cached_docs.get(code)
         if doc:
             cached += 1
             results.append(doc)
-            return
-
-        # 2. Throttled fetch
-        async with semaphore:
-            off_data = await crud.fetch_from_off(code)
-
+            continue
+
+        off_data = off_results.get(code)
+        if isinstance(off_data, crud.UpstreamThrottledError):
+            results.append({"barcode": code, "error": "OpenFoodFacts rate limit exceeded, try again later"})
+            continue
+        if isinstance(off_data, crud.UpstreamUnavailableError):
+            results.append({"barcode": code, "error": f"OpenFoodFacts unavailable (HTTP {off_data.status_code}), try again later"})
+            continue
+        if isinstance(off_data, Exception):
+            results.append({"barcode": code, "error": f"OpenFoodFacts request failed: {type(off_data).__name__}"})
+            continue
         if not off_data:
             results.append({"barcode": code, "error": "Not found in OpenFoodFacts"})
-            return
+            continue
 
         fetched += 1
-        new_products.append(off_data)
+        if code not in placeholder_idx:
+            new_products.append(off_data)
+            placeholder_idx[code] = []
+        placeholder_idx[code].append(len(results))
         results.append({"barcode": code, "_placeholder": True})
 
-    # Run all lookups
-    await asyncio.gather(*(process_one(c) for c in batch.barcodes))
-
     # Bulk upsert new products
     if new_products:
-        await crud.bulk_upsert_products(collection, new_products)
-        # Replace placeholders with real docs
-        for idx, item in enumerate(results):
-            if item.get("_placeholder"):
-                code = item["barcode"]
-                doc = await crud.get_product(collection, code)
+        upserted_ids = await crud.bulk_upsert_products(collection, new_products)
+        # Docs that already existed (e.g. a concurrent insert) have no upserted id
+        existing_ids = [d["barcode"] for d in new_products if d["barcode"] not in upserted_ids]
+        if existing_ids:
+            existing = await crud.get_products(collection, existing_ids)
+            upserted_ids.update({code: doc["_id"] for code, doc in existing.items()})
+        # Patch each placeholder in place with its in-memory doc
+        for d in new_products:
+            doc = {**d, "_id": upserted_ids.get(d["barcode"])}
+            for idx in placeholder_idx[d["barcode"]]:
                 results[idx] = doc
 
     metadata = BatchMetadata(requested=requested, fetched=fetched, cached=cached)
-    return BatchResponse(metadata=metadata, results=results)
+    # Docs come from our own collection / fetcher, so skip re-validation
+    items = [
+        ErrorOut.model_construct(**item) if "error" in item else ProductOut.from_doc(item)
+        for item in results
+    ]
+    return BatchResponse.model_construct(metadata=metadata, results=items)
 
 # ─── GET: other endpoints unchanged ───────
 
@@ -151,14 +198,14 @@ async def get_product(barcode: str):
     doc = await crud.get_product(collection, barcode)
     if not doc:
         raise HTTPException(404, "Product not found")
-    return doc
+    return ProductOut.from_doc(doc)
 
 @app.get("/product/{barcode}/nutrients", response_model=Nutriments)
 async def get_nutrients(barcode: str):
     doc = await crud.get_product(collection, barcode)
     if not doc or not doc.get("nutriments"):
         raise HTTPException(404, "Nutrition data not found")
-    return doc["nutriments"]
+    return Nutriments.model_construct(**doc["nutriments"])
 
 @app.get("/product/{barcode}/allergens")
 async def get_allergens(barcode: str):
@@ -172,11 +219,12 @@ async def get_eco(barcode: str):
     doc = await crud.get_product(collection, barcode)
     if not doc or not doc.get("eco"):
         raise HTTPException(404, "Eco data not found")
-    return doc["eco"]
+    return EcoScore.model_construct(**doc["eco"])
 
 @app.get("/search", response_model=List[ProductOut])
 async def search(q: str = Query(..., min_length=2)):
-    return await crud.search_products(collection, q)
+    docs = await crud.search_products(collection, q)
+    return [ProductOut.from_doc(d) for d in docs]
 
 @app.get("/", include_in_schema=False)
 async def read_root():
@@ -1,6 +1,6 @@
-from typing import List, Optional, Union, Any
+from typing import List, Optional, Union, Any, Dict, Annotated
 from bson import ObjectId
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Discriminator, Field, Tag
 from pydantic_core import core_schema
 from pydantic import GetCoreSchemaHandler, GetJsonSchemaHandler
 from pydantic.json_schema import JsonSchemaValue
@@ -14,7 +14,8 @@ class PyObjectId(ObjectId):
     ) -> core_schema.CoreSchema:
         return core_schema.no_info_after_validator_function(
             cls.validate,
-            core_schema.str_schema()
+            core_schema.str_schema(),
+            serialization=core_schema.to_string_ser_schema()
         )
 
     @classmethod
@@ -60,12 +61,20 @@ class ProductOut(BaseModel):
     allergens: Optional[List[str]]
     eco: Optional[EcoScore]
 
-    class Config:
-        populate_by_name = True
-        arbitrary_types_allowed = True
-        json_encoders = {
-            ObjectId: str
-        }
+    model_config = ConfigDict(populate_by_name=True, arbitrary_types_allowed=True)
+
+    @classmethod
+    def from_doc(cls, doc: Dict[str, Any]) -> "ProductOut":
+        """
+        Build from a trusted document of our own collection, skipping validation.
+        """
+        nutriments = doc.get("nutriments")
+        eco = doc.get("eco")
+        return cls.model_construct(**{
+            **doc,
+            "nutriments": Nutriments.model_construct(**nutriments) if nutriments else None,
+            "eco": EcoScore.model_construct(**eco) if eco else None,
+        })
 
 
 # === Error Wrapper Model ===
@@ -83,13 +92,23 @@ class BatchMetadata(BaseModel):
     cached: int
 
 
+def _batch_result_tag(v: Any) -> str:
+    # Error items are the ones carrying an "error" field
+    if isinstance(v, dict):
+        return "err" if "error" in v else "ok"
+    return "err" if isinstance(v, ErrorOut) else "ok"
+
+
+# Callable discriminator so Pydantic picks the member directly instead of
+# trying each, without adding a tag field to the response payloads
+BatchResult = Annotated[
+    Union[Annotated[ProductOut, Tag("ok")], Annotated[ErrorOut, Tag("err")]],
+    Discriminator(_batch_result_tag),
+]
+
+
 class BatchResponse(BaseModel):
     metadata: BatchMetadata
-    results: List[Union[ProductOut, ErrorOut]]
-
-    class Config:
-        populate_by_name = True
-        arbitrary_types_allowed = True
-        json_encoders = {
-            ObjectId: str
-        }
+    results: List[BatchResult]
+
+    model_config = ConfigDict(populate_by_name=True, arbitrary_types_allowed=True)
@@ -0,0 +1,362 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+from pymongo.errors import ServerSelectionTimeoutError
+
+import crud
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    caches = (
+        crud._off_cache,
+        crud._off_inflight,
+        crud._carbon_cache,
+        crud._carbon_inflight,
+        crud._host_gates,
+    )
+    for cache in caches:
+        cache.clear()
+    yield
+    for cache in caches:
+        cache.clear()
+
+
+# ─── AIMDLimiter ───────────────────────────
+
+def test_aimd_grows_on_fast_responses():
+    limiter = crud.AIMDLimiter(initial=2, max_limit=64, increase=0.5, target_latency=1.0)
+    for _ in range(4):
+        limiter.observe(0.01, 200)
+    assert limiter.limit == 4.0
+
+
+def test_aimd_grows_no_further_than_max_limit():
+    limiter = crud.AIMDLimiter(initial=3, max_limit=4, increase=0.5)
+    for _ in range(10):
+        limiter.observe(0.01, 200)
+    assert limiter.limit == 4
+
+
+def test_aimd_halves_on_throttled_response():
+    limiter = crud.AIMDLimiter(initial=8, decrease=0.5)
+    limiter.observe(0.01, 429)
+    assert limiter.limit == 4.0
+
+
+def test_aimd_halves_once_per_cooldown():
+    limiter = crud.AIMDLimiter(initial=8, decrease=0.5, cooldown=60)
+    for _ in range(3):
+        limiter.observe(0.01, 503)
+    assert limiter.limit == 4.0
+
+
+def test_aimd_halves_on_exception():
+    async def run():
+        limiter = crud.AIMDLimiter(initial=8, decrease=0.5)
+        with pytest.raises(RuntimeError):
+            async with limiter:
+                raise RuntimeError("boom")
+        return limiter.limit
+
+    assert asyncio.run(run()) == 4.0
+
+
+def test_aimd_halves_on_slow_responses():
+    limiter = crud.AIMDLimiter(initial=8, decrease=0.5, target_latency=0.01)
+    limiter.observe(0.05, 200)
+    assert limiter.limit == 4.0
+
+
+def test_aimd_caps_concurrency_at_limit():
+    async def run():
+        limiter = crud.AIMDLimiter(initial=3, increase=0, target_latency=10)
+        running = peak = 0
+
+        async def task():
+            nonlocal running, peak
+            async with limiter:
+                running += 1
+                peak = max(peak, running)
+                await asyncio.sleep(0.01)
+                running -= 1
+
+        await asyncio.gather(*(task() for _ in range(12)))
+        return peak
+
+    assert asyncio.run(run()) == 3
+
+
+# ─── SlidingWindowLimiter ──────────────────
+
+def test_sliding_window_caps_rate():
+    async def run():
+        limiter = crud.SlidingWindowLimiter(rate=5, period=0.2)
+        stamps = []
+
+        async def task():
+            await limiter.acquire()
+            stamps.append(time.monotonic())
+
+        await asyncio.gather(*(task() for _ in range(15)))
+        return sorted(stamps)
+
+    stamps = asyncio.run(run())
+    # 15 acquisitions at 5 per 0.2 s need at least two full windows
+    assert stamps[-1] - stamps[0] >= 0.4 - 0.01
+    # No rolling window ever holds more than `rate` acquisitions
+    for i in range(len(stamps) - 5):
+        assert stamps[i + 5] - stamps[i] >= 0.2 - 0.01
+
+
+# ─── cached_fetch_from_off ─────────────────
+
+def test_cached_fetch_single_flight(monkeypatch):
+    calls = []
+
+    async def fake_fetch(barcode, client, carbon_cache=None, limiter=None):
+        calls.append(barcode)
+        await asyncio.sleep(0.05)
+        return {"barcode": barcode}
+
+    monkeypatch.setattr(crud, "fetch_from_off", fake_fetch)
+
+    async def run():
+        return await asyncio.gather(
+            *(crud.cached_fetch_from_off("123", client=None) for _ in range(10))
+        )
+
+    results = asyncio.run(run())
+    assert calls == ["123"]
+    assert all(r == {"barcode": "123"} for r in results)
+
+
+def test_cached_fetch_serves_repeat_from_cache(monkeypatch):
+    calls = []
+
+    async def fake_fetch(barcode, client, carbon_cache=None, limiter=None):
+        calls.append(barcode)
+        return {"barcode": barcode}
+
+    monkeypatch.setattr(crud, "fetch_from_off", fake_fetch)
+
+    async def run():
+        await crud.cached_fetch_from_off("123", client=None)
+        await crud.cached_fetch_from_off("123", client=None)
+
+    asyncio.run(run())
+    assert calls == ["123"]
+
+
+def test_cached_fetch_does_not_cache_misses(monkeypatch):
+    calls = []
+
+    async def fake_fetch(barcode, client, carbon_cache=None, limiter=None):
+        calls.append(barcode)
+        return None
+
+    monkeypatch.setattr(crud, "fetch_from_off", fake_fetch)
+
+    async def run():
+        await crud.cached_fetch_from_off("404", client=None)
+        await crud.cached_fetch_from_off("404", client=None)
+
+    asyncio.run(run())
+    assert calls == ["404", "404"]
+
+
+# ─── _request_with_retry ───────────────────
+
+URL = "https://world.openfoodfacts.org/api/v0/product/1.json"
+
+
+def mock_client(*responses):
+    """AsyncClient that serves `responses` in order and records each request."""
+    queue = list(responses)
+    seen = []
+
+    def handler(request):
+        seen.append(request)
+        return queue.pop(0)
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler)), seen
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    delays = []
+    real_sleep = asyncio.sleep
+
+    async def fake_sleep(delay):
+        delays.append(delay)
+        await real_sleep(0)
+
+    monkeypatch.setattr(crud.asyncio, "sleep", fake_sleep)
+    return delays
+
+
+def test_retry_then_success(sleeps):
+    client, seen = mock_client(httpx.Response(429), httpx.Response(200, json={"ok": 1}))
+    resp = asyncio.run(crud._request_with_retry(client, "GET", URL))
+
+    assert resp.status_code == 200
+    assert len(seen) == 2
+    assert len(sleeps) == 1
+    assert crud.RETRY_BASE_DELAY <= sleeps[0] <= 2 * crud.RETRY_BASE_DELAY
+
+
+def test_backoff_grows_and_5xx_raises_unavailable(sleeps):
+    client, seen = mock_client(*[httpx.Response(503)] * crud.MAX_ATTEMPTS)
+
+    with pytest.raises(crud.UpstreamUnavailableError) as excinfo:
+        asyncio.run(crud._request_with_retry(client, "GET", URL))
+
+    assert excinfo.value.status_code == 503
+    assert len(seen) == crud.MAX_ATTEMPTS
+    assert len(sleeps) == crud.MAX_ATTEMPTS - 1
+    assert sleeps[1] > sleeps[0] - crud.RETRY_BASE_DELAY
+
+
+def test_exhausted_429_raises_throttled(sleeps):
+    client, _ = mock_client(*[httpx.Response(429)] * crud.MAX_ATTEMPTS)
+
+    with pytest.raises(crud.UpstreamThrottledError):
+        asyncio.run(crud._request_with_retry(client, "GET", URL))
+
+
+def test_retry_after_is_honored(sleeps):
+    client, _ = mock_client(
+        httpx.Response(429, headers={"Retry-After": "3"}),
+        httpx.Response(200),
+    )
+    resp = asyncio.run(crud._request_with_retry(client, "GET", URL))
+
+    assert resp.status_code == 200
+    assert sleeps == [3.0]
+
+
+def test_long_retry_after_fails_fast(sleeps):
+    client, seen = mock_client(
+        httpx.Response(429, headers={"Retry-After": "60"}),
+        httpx.Response(200),
+    )
+
+    with pytest.raises(crud.UpstreamThrottledError):
+        asyncio.run(crud._request_with_retry(client, "GET", URL))
+
+    assert len(seen) == 1
+    assert sleeps == []
+
+
+def test_retry_reports_each_response_to_limiter(sleeps):
+    client, _ = mock_client(httpx.Response(429), httpx.Response(200))
+    limiter = crud.AIMDLimiter(initial=8, decrease=0.5, increase=0.5)
+    asyncio.run(crud._request_with_retry(client, "GET", URL, limiter=limiter))
+
+    assert limiter.limit == 4.5  # halved on the 429, then grew on the 200
+    assert limiter._in_flight == 0
+
+
+def test_non_retryable_status_is_returned(sleeps):
+    client, seen = mock_client(httpx.Response(404))
+    resp = asyncio.run(crud._request_with_retry(client, "GET", URL))
+
+    assert resp.status_code == 404
+    assert len(seen) == 1
+    assert sleeps == []
+
+
+# ─── fetch_many_from_off ───────────────────
+
+def test_fetch_many_records_per_item_errors(monkeypatch):
+    async def fake_fetch(barcode, client, carbon_cache=None, limiter=None):
+        await asyncio.sleep(0.01)
+        if barcode == "down":
+            raise httpx.ConnectError("connection refused")
+        if barcode == "busy":
+            raise crud.UpstreamThrottledError("429", 429)
+        if barcode == "404":
+            return None
+        return {"barcode": barcode}
+
+    monkeypatch.setattr(crud, "fetch_from_off", fake_fetch)
+    limiter = crud.AIMDLimiter(initial=4)
+    results = asyncio.run(
+        crud.fetch_many_from_off(["1", "down", "2", "busy", "404"], None, limiter)
+    )
+
+    assert results["1"] == {"barcode": "1"}
+    assert results["2"] == {"barcode": "2"}
+    assert results["404"] is None
+    assert isinstance(results["down"], httpx.ConnectError)
+    assert isinstance(results["busy"], crud.UpstreamThrottledError)
+
+
+# ─── fetch_carbon_footprint ────────────────
+
+class FakeCarbonCache:
+    def __init__(self):
+        self.docs = {}
+        self.finds = 0
+
+    async def find_one(self, query):
+        self.finds += 1
+        return self.docs.get(query["_id"])
+
+    async def update_one(self, query, update, upsert=False):
+        self.docs[query["_id"]] = {"_id": query["_id"], **update["$set"]}
+
+
+def test_carbon_single_flight_per_rounded_grams(monkeypatch):
+    calls = []
+
+    async def fake_estimate(grams, client):
+        calls.append(grams)
+        await asyncio.sleep(0.05)
+        return 0.25
+
+    monkeypatch.setattr(crud, "request_carbon_estimate", fake_estimate)
+    mongo = FakeCarbonCache()
+
+    async def run():
+        return await asyncio.gather(
+            *(crud.fetch_carbon_footprint(g, None, mongo) for g in [100.0, 100.2, 99.9] * 7)
+        )
+
+    results = asyncio.run(run())
+    assert calls == [100]
+    assert mongo.finds == 1
+    assert set(results) == {0.25}
+    assert mongo.docs[100]["carbon_kg"] == 0.25
+
+
+def test_carbon_served_from_mongo_cache(monkeypatch):
+    async def fake_estimate(grams, client):
+        raise AssertionError("Carbon API should not be called")
+
+    monkeypatch.setattr(crud, "request_carbon_estimate", fake_estimate)
+    mongo = FakeCarbonCache()
+    mongo.docs[30] = {"_id": 30, "carbon_kg": 0.1}
+
+    assert asyncio.run(crud.fetch_carbon_footprint(30.0, None, mongo)) == 0.1
+    assert crud._carbon_cache[30] == 0.1
+
+
+class BrokenCarbonCache:
+    async def find_one(self, query):
+        raise ServerSelectionTimeoutError("mongo down")
+
+    async def update_one(self, query, update, upsert=False):
+        raise ServerSelectionTimeoutError("mongo down")
+
+
+def test_carbon_falls_back_to_api_when_mongo_cache_fails(monkeypatch):
+    async def fake_estimate(grams, client):
+        return 0.4
+
+    monkeypatch.setattr(crud, "request_carbon_estimate", fake_estimate)
+
+    assert asyncio.run(crud.fetch_carbon_footprint(50.0, None, BrokenCarbonCache())) == 0.4
+    assert crud._carbon_cache[50] == 0.4
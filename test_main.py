@@ -0,0 +1,40 @@
+from fastapi.testclient import TestClient
+
+import main
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def batch_size(self, n):
+        return self
+
+    def limit(self, n):
+        return self
+
+    async def __aiter__(self):
+        for doc in self.docs:
+            yield doc
+
+
+class FakeProducts:
+    def __init__(self, docs):
+        self.docs = docs
+        self.queries = []
+
+    def find(self, query, projection=None):
+        self.queries.append(query)
+        return FakeCursor(self.docs)
+
+
+def test_search_builds_regex_filter(monkeypatch):
+    products = FakeProducts([{"_id": "abc", "barcode": "1", "name": "Nutella"}])
+    monkeypatch.setattr(main, "collection", products)
+
+    resp = TestClient(main.app).get("/search", params={"q": "nut.lla"})
+
+    assert resp.status_code == 200
+    assert [p["barcode"] for p in resp.json()] == ["1"]
+    pattern = {"$regex": r"nut\.lla", "$options": "i"}
+    assert products.queries == [{"$or": [{"name": pattern}, {"brand": pattern}]}]